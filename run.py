@@ -12,16 +12,41 @@ import sys
 import json
 import yaml
 import re
+import io
+import string
 import os
+import pickle
+import hashlib
 import time
 import tempfile
 import datetime as dt
 import subprocess
 import argparse
+from contextlib import contextmanager
+from functools import lru_cache
 from pathlib import Path
 from bs4 import BeautifulSoup, Comment
 import pyperclip
 
+# Prefer the C-based lxml parser; fall back to the pure-Python stdlib parser.
+try:
+    import lxml  # noqa: F401
+    _HTML_PARSER = "lxml"
+except ImportError:
+    _HTML_PARSER = "html.parser"
+
+# Prefer the LibYAML-backed loader/dumper when PyYAML was built with it.
+try:
+    from yaml import CSafeLoader as _YLoader, CSafeDumper as _YDumper
+except ImportError:
+    from yaml import SafeLoader as _YLoader, SafeDumper as _YDumper
+
+# Optional: read the clipboard natively on Windows instead of spawning PowerShell
+try:
+    import win32clipboard
+except ImportError:
+    win32clipboard = None
+
 # --- Global State ---
 args = None
 
@@ -33,19 +58,43 @@ _LOCK_MAX_AGE = 300  # seconds before a lock file is considered stale (crash rec
 def acquire_lock() -> bool:
     """Try to acquire a process lock. Returns True if acquired, False if another instance is running."""
     _LOCK_DIR.mkdir(parents=True, exist_ok=True)
-    if _LOCK_FILE.exists():
-        age = time.time() - _LOCK_FILE.stat().st_mtime
+    try:
+        # O_EXCL makes check-and-create atomic, so two instances cannot both win
+        fd = os.open(_LOCK_FILE, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError:
+        try:
+            age = time.time() - _LOCK_FILE.stat().st_mtime
+        except FileNotFoundError:
+            return acquire_lock()  # Released in the meantime
         if age < _LOCK_MAX_AGE:
             return False  # Active lock held by another instance
         _LOCK_FILE.unlink(missing_ok=True)  # Stale lock (e.g. previous crash)
-    _LOCK_FILE.write_text(str(os.getpid()), encoding="utf-8")
+        return acquire_lock()
+    os.write(fd, str(os.getpid()).encode("utf-8"))
+    os.close(fd)
     return True
 
 def release_lock():
     _LOCK_FILE.unlink(missing_ok=True)
 
+@contextmanager
+def process_lock(enabled: bool = True):
+    """Hold the process lock for the duration of the block; yields False if another instance holds it."""
+    if not enabled:
+        yield True; return
+    if not acquire_lock():
+        yield False; return
+    try:
+        yield True
+    finally:
+        release_lock()
+
+def debug_enabled() -> bool:
+    return bool(args and args.debug)
+
 def log_debug(msg):
-    if args and args.debug:
+    # Call sites in hot paths check debug_enabled() first so the message is not even formatted
+    if debug_enabled():
         print(f"DEBUG: {msg}", file=sys.stderr)
 
 def log_warn(msg):
@@ -54,6 +103,32 @@ def log_warn(msg):
 
 # --- Configuration ---
 
+_CACHE_DIR = _LOCK_DIR
+
+def _load_yaml(path: Path):
+    """Load a YAML file, caching the parsed result as a pickle keyed by path and mtime."""
+    st = path.stat()
+    stem = "yaml-" + hashlib.sha1(str(path.resolve()).encode("utf-8")).hexdigest()[:12]
+    cache_path = _CACHE_DIR / f"{stem}-{st.st_mtime_ns}-{st.st_size}.pkl"
+    try:
+        with open(cache_path, "rb") as f:
+            return pickle.load(f)
+    except Exception:
+        pass
+
+    data = yaml.load(path.read_text(encoding="utf-8"), Loader=_YLoader)
+    try:
+        _CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        for old in _CACHE_DIR.glob(f"{stem}-*.pkl"):
+            old.unlink(missing_ok=True)  # Outdated cache for a previous mtime
+        tmp_path = cache_path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        log_debug(f"Failed to write YAML cache for {path.name}: {e}")
+    return data
+
 def get_config_paths():
     """Get candidate paths for config.yaml and the folder for storage."""
     base_dir = Path(__file__).resolve().parent
@@ -115,7 +190,7 @@ def interactive_setup(config_paths):
     print(f"\nSaving configuration to: {target_path}")
     try:
         with open(target_path, "w", encoding="utf-8") as f:
-            yaml.dump(new_config, f, allow_unicode=True, default_flow_style=False, sort_keys=False)
+            yaml.dump(new_config, f, Dumper=_YDumper, allow_unicode=True, default_flow_style=False, sort_keys=False)
         print("Setup complete!\n")
     except Exception as e:
         print(f"Failed to save configuration: {e}")
@@ -151,7 +226,7 @@ def load_config():
     def load_file(path):
         if not path or not path.exists(): return {}
         try:
-            data = yaml.safe_load(path.read_text(encoding="utf-8")) or {}
+            data = _load_yaml(path) or {}
             def normalize(d):
                 if isinstance(d, dict):
                     return {k: normalize(v) for k, v in d.items()}
@@ -171,7 +246,7 @@ def load_config():
             try:
                 data = json.loads(json_path.read_text(encoding="utf-8"))
                 with open(yaml_path, "w", encoding="utf-8") as f:
-                    yaml.dump(data, f, allow_unicode=True, default_flow_style=False, sort_keys=False)
+                    yaml.dump(data, f, Dumper=_YDumper, allow_unicode=True, default_flow_style=False, sort_keys=False)
                 json_path.rename(json_path.with_name(json_path.name + ".bak"))
                 log_debug(f"Migrated {json_path.name} to {yaml_path.name}")
             except Exception as e:
@@ -222,6 +297,75 @@ def load_config():
                 
     return config
 
+# --- Toast notifications ---
+
+_TOKEN_RE = re.compile(r"\{([^{}]+)\}")
+
+def fill_tokens(template: str, values: dict[str, str]) -> str:
+    """Replace {token} placeholders in a single pass, leaving unknown tokens untouched."""
+    return _TOKEN_RE.sub(lambda m: values.get(m.group(1), m.group(0)), template)
+
+# Defines Show-ChatToast in a long-lived PowerShell host. Each toast is sent as a
+# single stdin line carrying Base64-encoded JSON, so quoting and console encoding
+# never matter and the WinRT setup runs once per process.
+_TOAST_PS = r"""
+# Official Windows PowerShell AUMID (Required for reliable protocol activation/clicks)
+$appId = '{1AC14E77-02E7-4E5D-B744-2EB1AE5198B7}\WindowsPowerShell\v1.0\powershell.exe'
+[Windows.UI.Notifications.ToastNotificationManager, Windows.UI.Notifications, ContentType = WindowsRuntime] | Out-Null
+$templateXml = [Windows.UI.Notifications.ToastNotificationManager]::GetTemplateContent([Windows.UI.Notifications.ToastTemplateType]::ToastText02).GetXml()
+
+function global:Show-ChatToast($payload) {
+    $t = [Text.Encoding]::UTF8.GetString([Convert]::FromBase64String($payload)) | ConvertFrom-Json
+    $xml = [xml]$templateXml
+
+    # Set Text
+    $xml.GetElementsByTagName('text')[0].AppendChild($xml.CreateTextNode($t.title)) | Out-Null
+    $xml.GetElementsByTagName('text')[1].AppendChild($xml.CreateTextNode($t.message)) | Out-Null
+
+    # Set Activation
+    if ($t.launch) {
+        $xml.toast.SetAttribute('launch', $t.launch)
+        $xml.toast.SetAttribute('activationType', 'protocol')
+    }
+
+    # Set Audio
+    if ($t.silent) {
+        $audio = $xml.CreateElement('audio')
+        $audio.SetAttribute('silent', 'true')
+        $xml.GetElementsByTagName('toast')[0].AppendChild($audio) | Out-Null
+    }
+
+    $toastXml = New-Object Windows.Data.Xml.Dom.XmlDocument
+    $toastXml.LoadXml($xml.OuterXml)
+    $toast = New-Object Windows.UI.Notifications.ToastNotification $toastXml
+    [Windows.UI.Notifications.ToastNotificationManager]::CreateToastNotifier($appId).Show($toast)
+}
+""".strip()
+
+_toast_host = None
+
+def _send_toast(title: str, message: str, launch: str = "", silent: bool = True):
+    """Queue a toast on the shared PowerShell host, starting it on first use."""
+    global _toast_host
+    import base64
+    if _toast_host is None or _toast_host.poll() is not None:
+        CREATE_NO_WINDOW = 0x08000000
+        _toast_host = subprocess.Popen(
+            ['powershell', '-NoProfile', '-ExecutionPolicy', 'Bypass', '-WindowStyle', 'Hidden', '-Command', '-'],
+            stdin=subprocess.PIPE,
+            creationflags=CREATE_NO_WINDOW,
+            close_fds=True
+        )
+        script_b64 = base64.b64encode(_TOAST_PS.encode("utf-8")).decode("ascii")
+        _toast_host.stdin.write(
+            f". ([ScriptBlock]::Create([Text.Encoding]::UTF8.GetString([Convert]::FromBase64String('{script_b64}'))))\n".encode("ascii")
+        )
+    payload = json.dumps({"title": str(title), "message": str(message), "launch": launch, "silent": silent})
+    payload_b64 = base64.b64encode(payload.encode("utf-8")).decode("ascii")
+    # The host exits on its own once stdin closes when this process ends
+    _toast_host.stdin.write(f"Show-ChatToast '{payload_b64}'\n".encode("ascii"))
+    _toast_host.stdin.flush()
+
 def show_toast(config, model_name, summary, turn_count=0, filepath: Path = None):
     """Show Windows Toast notification via PowerShell.
     Uses protocol activation for clicking the toast to open the file reliably."""
@@ -233,8 +377,9 @@ def show_toast(config, model_name, summary, turn_count=0, filepath: Path = None)
     if not toast_cfg.get("enabled"): return
 
     turns_str = str(turn_count)
-    title = toast_cfg.get("title", "Chat Extracted ({model}) [{turns} turns]").replace("{ai model}", model_name).replace("{model}", model_name).replace("{turns}", turns_str).replace("{n}", turns_str)
-    msg = toast_cfg.get("message", "{short summary}").replace("{ai model}", model_name).replace("{model}", model_name).replace("{short summary}", summary).replace("{turns}", turns_str).replace("{n}", turns_str)
+    tokens = {"ai model": model_name, "model": model_name, "short summary": summary, "turns": turns_str, "n": turns_str}
+    title = fill_tokens(toast_cfg.get("title", "Chat Extracted ({model}) [{turns} turns]"), tokens)
+    msg = fill_tokens(toast_cfg.get("message", "{short summary}"), tokens)
     
     sound = notice.get("sound", {})
     is_silent = not sound.get("enabled", True)
@@ -242,49 +387,7 @@ def show_toast(config, model_name, summary, turn_count=0, filepath: Path = None)
     open_on_click = toast_cfg.get("open_on_click", True)
     can_open = filepath and filepath.exists() and open_on_click
 
-    # Official Windows PowerShell AUMID (Required for reliable protocol activation/clicks)
-    app_id = r"{1AC14E77-02E7-4E5D-B744-2EB1AE5198B7}\WindowsPowerShell\v1.0\powershell.exe"
-
-    # Escape strings for PowerShell (single quotes)
-    def ps_esc(s): return str(s).replace("'", "''")
-
-    ps_code = f"""
-$appId = '{ps_esc(app_id)}'
-[Windows.UI.Notifications.ToastNotificationManager, Windows.UI.Notifications, ContentType = WindowsRuntime] | Out-Null
-$template = [Windows.UI.Notifications.ToastNotificationManager]::GetTemplateContent([Windows.UI.Notifications.ToastTemplateType]::ToastText02)
-$xml = [xml]$template.GetXml()
-
-# Set Text
-$xml.GetElementsByTagName('text')[0].AppendChild($xml.CreateTextNode('{ps_esc(title)}')) | Out-Null
-$xml.GetElementsByTagName('text')[1].AppendChild($xml.CreateTextNode('{ps_esc(msg)}')) | Out-Null
-
-# Set Activation
-if ('{str(can_open).lower()}' -eq 'true') {{
-    $xml.toast.SetAttribute('launch', '{ps_esc(filepath.absolute().as_uri() if can_open else "")}')
-    $xml.toast.SetAttribute('activationType', 'protocol')
-}}
-
-# Set Audio
-if ('{str(is_silent).lower()}' -eq 'true') {{
-    $audio = $xml.CreateElement('audio')
-    $audio.SetAttribute('silent', 'true')
-    $xml.GetElementsByTagName('toast')[0].AppendChild($audio) | Out-Null
-}}
-
-$toastXml = New-Object Windows.Data.Xml.Dom.XmlDocument
-$toastXml.LoadXml($xml.OuterXml)
-$toast = New-Object Windows.UI.Notifications.ToastNotification $toastXml
-[Windows.UI.Notifications.ToastNotificationManager]::CreateToastNotifier($appId).Show($toast)
-""".strip()
-
-    import base64
-    encoded_ps = base64.b64encode(ps_code.encode("utf-16le")).decode("ascii")
-    CREATE_NO_WINDOW = 0x08000000
-    subprocess.Popen(
-        ['powershell', '-NoProfile', '-ExecutionPolicy', 'Bypass', '-WindowStyle', 'Hidden', '-EncodedCommand', encoded_ps],
-        creationflags=CREATE_NO_WINDOW,
-        close_fds=True
-    )
+    _send_toast(title, msg, launch=filepath.absolute().as_uri() if can_open else "", silent=is_silent)
 
 def show_status_toast(config, title: str, message: str):
     """Show a fast, always-silent status toast (processing / busy)."""
@@ -294,37 +397,21 @@ def show_status_toast(config, title: str, message: str):
     toast_cfg = notice.get("toast", {})
     if not toast_cfg.get("enabled"): return
 
-    app_id = r"{1AC14E77-02E7-4E5D-B744-2EB1AE5198B7}\WindowsPowerShell\v1.0\powershell.exe"
-    def ps_esc(s): return str(s).replace("'", "''")
+    _send_toast(title, message, silent=True)
 
-    ps_code = f"""
-$appId = '{ps_esc(app_id)}'
-[Windows.UI.Notifications.ToastNotificationManager, Windows.UI.Notifications, ContentType = WindowsRuntime] | Out-Null
-$template = [Windows.UI.Notifications.ToastNotificationManager]::GetTemplateContent([Windows.UI.Notifications.ToastTemplateType]::ToastText02)
-$xml = [xml]$template.GetXml()
-$xml.GetElementsByTagName('text')[0].AppendChild($xml.CreateTextNode('{ps_esc(title)}')) | Out-Null
-$xml.GetElementsByTagName('text')[1].AppendChild($xml.CreateTextNode('{ps_esc(message)}')) | Out-Null
-$audio = $xml.CreateElement('audio'); $audio.SetAttribute('silent', 'true'); $xml.GetElementsByTagName('toast')[0].AppendChild($audio) | Out-Null
-$toastXml = New-Object Windows.Data.Xml.Dom.XmlDocument
-$toastXml.LoadXml($xml.OuterXml)
-$toast = New-Object Windows.UI.Notifications.ToastNotification $toastXml
-[Windows.UI.Notifications.ToastNotificationManager]::CreateToastNotifier($appId).Show($toast)
-""".strip()
-
-    import base64
-    encoded_ps = base64.b64encode(ps_code.encode("utf-16le")).decode("ascii")
-    CREATE_NO_WINDOW = 0x08000000
-    subprocess.Popen(
-        ['powershell', '-NoProfile', '-ExecutionPolicy', 'Bypass', '-WindowStyle', 'Hidden', '-EncodedCommand', encoded_ps],
-        creationflags=CREATE_NO_WINDOW,
-        close_fds=True
-    )
+_HIGH_CHAR_RE = re.compile('[\u1001-\U0010ffff]')
+# UTF-8 multi-byte lead bytes (0xC2-0xF4) as they appear after a Latin-1/CP1252 decode
+_MOJIBAKE_LEAD_RE = re.compile('[\u00c2-\u00f4]')
+_CJK_RE = re.compile('[\u3000-\U0010ffff]')
 
 def try_repair_mojibake(text: str) -> str:
     """Repair strings where UTF-8 bytes were misinterpreted as Latin-1 or other single-byte encodings."""
     # Common problem: UTF-8 bytes read as Latin-1 (ã ® -> の) or CP1252
     # If the text already has high-code characters that don't look like mojibake (e.g. Japanese), skip
-    if any(ord(c) > 0x1000 for c in text):
+    if _HIGH_CHAR_RE.search(text):
+        return text
+    # Without any misdecoded lead byte there is nothing to repair
+    if not _MOJIBAKE_LEAD_RE.search(text):
         return text
 
     for enc in ['latin-1', 'cp1252']:
@@ -335,55 +422,98 @@ def try_repair_mojibake(text: str) -> str:
             repaired_text = repaired_bytes.decode('utf-8')
             
             # Heuristic: if repaired text has CJK characters, it's probably correct
-            if any(ord(c) >= 0x3000 for c in repaired_text):
+            if _CJK_RE.search(repaired_text):
                 return repaired_text
         except (UnicodeEncodeError, UnicodeDecodeError):
             continue
     return text
 
-def get_clipboard_raw_b64():
-    """Get raw clipboard data as Base64 string from PowerShell."""
-    if sys.platform != "win32":
-        return None
-    
+def _get_clipboard_powershell() -> bytes | None:
+    """Get raw clipboard bytes via PowerShell, which writes them to a temp file
+    (faster than piping a large payload through stdout)."""
     try:
-        ps_cmd = (
-            "Add-Type -AssemblyName System.Windows.Forms; "
-            "$do = [Windows.Forms.Clipboard]::GetDataObject(); "
-            "$data = $null; "
-            "if ($do.GetFormats() -contains 'Html') { $data = $do.GetData('Html') } "
-            "else { $data = [Windows.Forms.Clipboard]::GetText() } "
-            "if ($data) { "
-            "  if ($data -is [System.IO.MemoryStream]) { $bytes = $data.ToArray() } "
-            "  else { $bytes = [System.Text.Encoding]::UTF8.GetBytes($data.ToString()) } "
-            "  [Convert]::ToBase64String($bytes) "
-            "}"
-        )
-        cmd = ["powershell", "-NoProfile", "-Command", ps_cmd]
-        result = subprocess.run(cmd, capture_output=True)
-        if result.returncode == 0 and result.stdout.strip():
-            return result.stdout.decode('ascii', errors='ignore').strip()
+        fd, tmp_name = tempfile.mkstemp(prefix="clipboard-", suffix=".bin")
+        os.close(fd)
+        tmp_path = Path(tmp_name)
+        try:
+            ps_cmd = (
+                "Add-Type -AssemblyName System.Windows.Forms; "
+                "$do = [Windows.Forms.Clipboard]::GetDataObject(); "
+                "$data = $null; "
+                "if ($do.GetFormats() -contains 'Html') { $data = $do.GetData('Html') } "
+                "else { $data = [Windows.Forms.Clipboard]::GetText() } "
+                "if ($data) { "
+                "  if ($data -is [System.IO.MemoryStream]) { $bytes = $data.ToArray() } "
+                "  else { $bytes = [System.Text.Encoding]::UTF8.GetBytes($data.ToString()) } "
+                "  [System.IO.File]::WriteAllBytes($env:CHAT_EXTRACTOR_CLIP_OUT, $bytes) "
+                "}"
+            )
+            cmd = ["powershell", "-NoProfile", "-Command", ps_cmd]
+            env = dict(os.environ, CHAT_EXTRACTOR_CLIP_OUT=str(tmp_path))
+            result = subprocess.run(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            if result.returncode == 0:
+                return tmp_path.read_bytes() or None
+        finally:
+            tmp_path.unlink(missing_ok=True)
     except Exception:
         pass
     return None
 
+def _get_clipboard_native() -> bytes | None:
+    """Read CF_HTML (or Unicode text) directly via pywin32."""
+    if win32clipboard is None:
+        return None
+    try:
+        win32clipboard.OpenClipboard()
+        try:
+            html_fmt = win32clipboard.RegisterClipboardFormat("HTML Format")
+            if win32clipboard.IsClipboardFormatAvailable(html_fmt):
+                data = win32clipboard.GetClipboardData(html_fmt)
+            elif win32clipboard.IsClipboardFormatAvailable(win32clipboard.CF_UNICODETEXT):
+                data = win32clipboard.GetClipboardData(win32clipboard.CF_UNICODETEXT)
+            else:
+                data = None
+        finally:
+            win32clipboard.CloseClipboard()
+    except Exception as e:
+        log_debug(f"Native clipboard read failed: {e}")
+        return None
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return data.rstrip(b"\0") if data else None
+
+_FRAGMENT_START = "<!--StartFragment-->"
+_FRAGMENT_END = "<!--EndFragment-->"
+
+def slice_fragment(content: str) -> str | None:
+    """Return the CF_HTML fragment between the first StartFragment and the last
+    EndFragment marker, or None if the markers are missing."""
+    i = content.find(_FRAGMENT_START)
+    if i == -1: return None
+    i += len(_FRAGMENT_START)
+    j = content.rfind(_FRAGMENT_END, i)
+    return content[i:j] if j != -1 else None
+
+def get_clipboard_raw() -> bytes | None:
+    """Get raw clipboard bytes, natively if pywin32 is installed, otherwise via PowerShell."""
+    if sys.platform != "win32":
+        return None
+    raw_bytes = _get_clipboard_native()
+    if raw_bytes is None:
+        raw_bytes = _get_clipboard_powershell()
+    return raw_bytes
+
 def get_clipboard_html():
     """Attempt to get HTML or Text from clipboard.
     If the content is a file path to a supported document, read it."""
-    b64_str = get_clipboard_raw_b64()
+    raw_bytes = get_clipboard_raw()
     full_raw = ""
-    if b64_str:
-        import base64
+    if raw_bytes:
         try:
-            raw_bytes = base64.b64decode(b64_str)
-            try:
-                full_raw = raw_bytes.decode('utf-8')
-            except UnicodeDecodeError:
-                full_raw = raw_bytes.decode('cp932', errors='replace')
-            
-            full_raw = try_repair_mojibake(full_raw)
-        except Exception as e:
-            log_debug(f"Clipboard decoding error: {e}")
+            full_raw = raw_bytes.decode('utf-8')
+        except UnicodeDecodeError:
+            full_raw = raw_bytes.decode('cp932', errors='replace')
+        full_raw = try_repair_mojibake(full_raw)
     
     if not full_raw:
         full_raw = try_repair_mojibake(pyperclip.paste())
@@ -408,61 +538,110 @@ def get_clipboard_html():
                 # Fall back to using the path string itself (though it likely won't be valid HTML)
 
     if "StartFragment:" in full_raw:
-        match = re.search(r'<!--StartFragment-->(.*)<!--EndFragment-->', full_raw, re.DOTALL)
-        if match: return match.group(1)
+        fragment = slice_fragment(full_raw)
+        if fragment is not None: return fragment
     
     return full_raw
 
 # --- Logic from scripts/collector ---
 
+# Text headers that introduce a turn in plain-text or header-only HTML input
+_USER_HEADER_RE = re.compile(r"^(You|User) said$|^You$|^User$|^##\s*User$|^User:$", re.I)
+_AI_HEADER_RE = re.compile(r"^(Gemini|ChatGPT|Claude|AI) said$|^(Gemini|ChatGPT|Claude|AI)$|^##\s*AI$|^(Gemini|ChatGPT|Claude|AI):$", re.I)
+_WS_RE = re.compile(r'\s+')
+_HEADING_TAG_RE = re.compile(r"^h[1-6]$")
+# "<Speaker> said" label lines, or lines that contain only spaces/tabs
+_LINE_NOISE_RE = re.compile(r"^(?:\s*.+ said\s*|[ \t]+)$", re.M | re.I)
+_BLANK_LINES_RE = re.compile(r'\n{3,}')
+_PIPE_ESCAPE = str.maketrans({"|": "\\|"})
+
+@lru_cache(maxsize=512)
+def _noise_re(pattern: str) -> re.Pattern:
+    """Compiled regex matching a whole line that consists of the given noise string."""
+    return re.compile(rf"^\s*{re.escape(pattern)}\s*$", re.M | re.I)
+
+@lru_cache(maxsize=32)
+def _table_sep(cols: int) -> str:
+    """Markdown header separator row for a table with the given number of columns."""
+    return "| " + " | ".join(["---"] * cols) + " |"
+
+def _parse_html(markup: str) -> BeautifulSoup:
+    return BeautifulSoup(markup, _HTML_PARSER)
+
+def _is_plain_text(soup: BeautifulSoup) -> bool:
+    """True if the soup has no real tags (lxml wraps bare text in <html><body>)."""
+    return soup.find(lambda t: t.name not in ("html", "body")) is None
+
+_PROFILES_CACHE: dict[str, dict] | None = None
+
 def load_profiles() -> dict[str, dict]:
+    """Load model profiles once per process."""
+    global _PROFILES_CACHE
+    if _PROFILES_CACHE is None:
+        _PROFILES_CACHE = _load_profiles_impl()
+    return _PROFILES_CACHE
+
+def _load_profiles_impl() -> dict[str, dict]:
     models_dir = Path(__file__).resolve().parent / "models"
     profiles = {}
     if not models_dir.exists(): return {}
     for p_path in models_dir.glob("*.yaml"):
         try:
-            data = yaml.safe_load(p_path.read_text(encoding="utf-8"))
+            data = _load_yaml(p_path)
             if data:
+                # Pre-join each role's selectors so a single CSS query can test all of them
+                data["_compiled_selectors"] = {
+                    role: ", ".join(sels) for role, sels in (data.get("content_selectors") or {}).items() if sels
+                }
                 profiles[p_path.stem] = data
         except Exception as e:
             log_warn(f"Failed to load profile {p_path.name}: {e}")
     return profiles
 
-def detect_profile(soup: BeautifulSoup, profiles: dict[str, dict]) -> tuple[str, dict]:
-    for key, profile in profiles.items():
-        if profile.get("method") == "tag_stream":
-            for tag in profile.get("tags", []):
-                if soup.find(tag): return key, profile
-        elif profile.get("method") == "container_list":
-            sel = profile.get("container_selector")
-            if sel and soup.select_one(sel): return key, profile
-        elif profile.get("method") == "turn_list":
-            sel = profile.get("detect_selector") or profile.get("turn_selector")
-            if sel and soup.select_one(sel): return key, profile
-        elif profile.get("method") == "sequence_pair":
-            sel = profile.get("scope_selector")
-            if sel and soup.select_one(sel): return key, profile
-
-    # Fallback search for model names
-    text_content = soup.get_text().lower()
-    if "gemini" in text_content: return "gemini", profiles.get("gemini", {})
-    if "chatgpt" in text_content: return "chatgpt", profiles.get("chatgpt", {})
+def detect_profile(soup: BeautifulSoup | None, html_str: str, profiles: dict[str, dict]) -> tuple[str, dict]:
+    # soup is None for plain-text input, which no selector can match
+    if soup is not None:
+        for key, profile in profiles.items():
+            if profile.get("method") == "tag_stream":
+                for tag in profile.get("tags", []):
+                    if soup.find(tag): return key, profile
+            elif profile.get("method") == "container_list":
+                sel = profile.get("container_selector")
+                if sel and soup.select_one(sel): return key, profile
+            elif profile.get("method") == "turn_list":
+                sel = profile.get("detect_selector") or profile.get("turn_selector")
+                if sel and soup.select_one(sel): return key, profile
+            elif profile.get("method") == "sequence_pair":
+                sel = profile.get("scope_selector")
+                if sel and soup.select_one(sel): return key, profile
+
+    # Fallback search for model names in the source (a prefix is enough and avoids
+    # materializing the whole document text)
+    head = html_str[:65536].lower()
+    if "gemini" in head: return "gemini", profiles.get("gemini", {})
+    if "chatgpt" in head: return "chatgpt", profiles.get("chatgpt", {})
     
     for key, profile in profiles.items():
         if profile.get("is_default"): return key, profile
     return "unknown", {}
 
-def clean_fragment_html(fragment_html: str) -> str:
-    # Use 'html.parser' but be careful with fragment behavior
-    soup = BeautifulSoup(fragment_html, "html.parser")
-    for tag_name in ("script", "style", "noscript", "svg", "path", "button", "mat-icon", "nav", "aside"):
-        for el in soup.find_all(tag_name): el.decompose()
-    for comment in soup.find_all(string=lambda t: isinstance(t, Comment)): comment.extract()
-    
-    # Return inner HTML of body or the whole thing if no body
-    if soup.body:
-        return "".join(str(c) for c in soup.body.children).strip()
-    return "".join(str(c) for c in soup.children).strip()
+# Non-content elements stripped from extracted turns
+_JUNK_TAGS = ("script", "style", "noscript", "svg", "path", "button", "mat-icon", "nav", "aside")
+# Elements that are never rendered, dropped from the page right after parsing
+_NON_RENDERED_TAGS = ("script", "style", "noscript", "template", "svg")
+
+def clean_fragment(fragment_html: str) -> BeautifulSoup:
+    """Parse a turn fragment and strip non-content elements and comments."""
+    soup = _parse_html(fragment_html)
+    for el in soup.find_all(_JUNK_TAGS): el.decompose()
+    for comment in soup.find_all(string=lambda t: t.__class__ is Comment): comment.extract()
+    return soup
+
+def _has_content(soup: BeautifulSoup) -> bool:
+    """True if the fragment has any element or non-whitespace text."""
+    # lxml wraps fragments in <html><body>; html.parser does not.
+    root = soup.body or soup
+    return any(c.name or c.strip() for c in root.children)
 
 def detect_role(tag, profile: dict) -> str:
     """Detects role (user/ai) for a tag using attributes or child selectors."""
@@ -473,77 +652,144 @@ def detect_role(tag, profile: dict) -> str:
             return profile["role_map"][val]
             
     # Check content selectors as fallback
-    for role_key, selectors in profile.get("content_selectors", {}).items():
-        for sel in selectors:
-            if tag.select_one(f":scope {sel}") or tag.select_one(sel):
-                return role_key
+    for role_key, joined_sel in profile.get("_compiled_selectors", {}).items():
+        if tag.select_one(joined_sel):
+            return role_key
     return "unknown"
 
-def extract_content_by_selectors(tag, selectors, fallback_html=True) -> str:
-    parts: list[str] = []; found = False
-    for sel in selectors:
-        # Check if the tag itself matches the selector
-        if tag.select_one(f":scope > {sel}") or tag.select_one(sel):
-             el = tag.select_one(sel)
-             if el: parts.append(el.decode_contents()); found = True; break
-    
-    if not found and fallback_html:
+def extract_content_by_selectors(tag, selectors, fallback_html=True, joined_selector=None) -> str:
+    el = None
+    if selectors:
+        # One traversal collects the matches of every selector; list order still decides priority
+        matches = tag.select(joined_selector or ", ".join(selectors))
+        el = next((m for sel in selectors for m in matches if m.css.match(sel)), None)
+
+    if el is not None:
+        content = el.decode_contents()
+    elif fallback_html:
         # If no internal content element found, treat the whole tag's content as the message
-        parts.append(tag.decode_contents())
+        content = tag.decode_contents()
+    else:
+        content = ""
+    return content if content.strip() else ""
+
+_FALLBACK_TAGS = frozenset(("div", "p", "span", "section", "article"))
+
+def _iter_fallback_candidates(root):
+    """Yield (element, nested) for each fallback candidate tag in document order.
+    nested is True when the element sits inside another candidate; tracking it during
+    the walk avoids scanning every element's ancestors."""
+    stack = [(iter(root.children), False)]
+    while stack:
+        children, nested = stack[-1]
+        for child in children:
+            if child.name is None: continue
+            if child.name in _FALLBACK_TAGS:
+                yield child, nested
+                stack.append((iter(child.children), True))
+            else:
+                stack.append((iter(child.children), nested))
+            break
+        else:
+            stack.pop()
+
+# Far longer than any turn header, even with whitespace padding inside "##  User"
+_HEADER_TEXT_MAX = 256
+
+def _short_text(elem, limit: int = _HEADER_TEXT_MAX) -> str | None:
+    """Return elem.get_text().strip(), or None as soon as it is known to exceed limit.
+    Header checks only need short texts, so large containers are not read in full."""
+    parts = []; text_len = 0; pending_ws = 0
+    for s in elem.strings:
+        parts.append(s)
+        body = s.rstrip()
+        if not body:
+            pending_ws += len(s)
+            continue
+        text_len = text_len + pending_ws + len(body) if text_len else len(body.lstrip())
+        pending_ws = len(s) - len(body)
+        if text_len > limit:
+            return None
+    return "".join(parts).strip()
+
+def _leading_text(elem, n: int) -> str:
+    """Return elem.get_text().strip()[:n], reading only as many strings as needed."""
+    parts = []; size = 0; end = 0
+    for s in elem.strings:
+        if not parts:
+            s = s.lstrip()
+            if not s: continue
+        parts.append(s)
+        body = s.rstrip()
+        if body: end = size + len(body)
+        size += len(s)
+        if end > n: break
+    return "".join(parts).rstrip()[:n]
+
+def _extract_plaintext_turns(text_content: str) -> list[dict]:
+    """Simple line-based turn detection for plain text."""
+    turns: list[dict] = []
+    current_role, current_lines = None, []
+    def flush():
+        if current_role and current_lines:
+            text = "\n".join(current_lines).strip()
+            if text: turns.append({"role": current_role, "tag": _parse_html(f"<p>{text}</p>")})
     
-    return clean_fragment_html("\n".join(p for p in parts if p and p.strip()))
+    for line in text_content.split("\n"):
+        line = line.strip()
+        if not line: continue
+        if _USER_HEADER_RE.match(line):
+            flush(); current_role, current_lines = "user", []
+        elif _AI_HEADER_RE.match(line):
+            flush(); current_role, current_lines = "ai", []
+        elif current_role:
+            current_lines.append(line)
+    flush()
+    return turns
 
-def extract_turns_from_soup(soup: BeautifulSoup, profile: dict) -> list[dict[str, str]]:
+def extract_turns_from_soup(soup: BeautifulSoup, profile: dict) -> list[dict]:
     main_sel = profile.get("main_selector")
     if main_sel:
         main = soup.select_one(main_sel)
         if main: soup = main
 
-    turns: list[dict[str, str]] = []
+    # Drop non-content subtrees once up front so they are never serialized into
+    # turn fragments and parsed again (SoupStrainer cannot exclude nested subtrees)
+    for el in soup.find_all(_JUNK_TAGS): el.decompose()
+
+    turns: list[dict] = []
+
+    def add_turn(role, fragment_html) -> bool:
+        # Keep the cleaned soup so neither the title nor the Markdown conversion parses the turn again
+        cleaned = clean_fragment(fragment_html)
+        if not _has_content(cleaned): return False
+        turns.append({"role": role, "tag": cleaned})
+        return True
     
     # Try Regex detection for plain text first if no tags found or as extra measure
-    text_content = soup.get_text("\n")
-    if not soup.find(): # No tags, likely plain text
-        # Simple line-based turn detection
-        lines = text_content.split("\n")
-        current_role, current_lines = None, []
-        # Support basic model identification and various header styles
-        user_patterns = [r"^(You|User) said$", r"^You$", r"^User$", r"^##\s*User$", r"^User:$"]
-        ai_patterns = [r"^(Gemini|ChatGPT|Claude|AI) said$", r"^(Gemini|ChatGPT|Claude|AI)$", r"^##\s*AI$", r"^(Gemini|ChatGPT|Claude|AI):$"]
-        
-        def flush():
-            if current_role and current_lines:
-                text = "\n".join(current_lines).strip()
-                if text: turns.append({"role": current_role, "html": f"<p>{text}</p>"})
-        
-        for line in lines:
-            line = line.strip()
-            if not line: continue
-            is_user = any(re.match(p, line, re.I) for p in user_patterns)
-            is_ai = any(re.match(p, line, re.I) for p in ai_patterns)
-            
-            if is_user:
-                flush(); current_role, current_lines = "user", []
-            elif is_ai:
-                flush(); current_role, current_lines = "ai", []
-            elif current_role:
-                current_lines.append(line)
-        flush()
+    if _is_plain_text(soup): # No tags, likely plain text
+        turns = _extract_plaintext_turns(soup.get_text("\n"))
         if turns: return turns
 
     method = profile.get("method", "tag_stream")
     if method == "tag_stream":
         tags, role_map = profile.get("tags", []), profile.get("role_map", {})
         content_selectors = profile.get("content_selectors", {})
+        compiled_selectors = profile.get("_compiled_selectors", {})
         fallback_ai = profile.get("fallback_ai_text", False)
+        # Resolve each role's selectors once rather than per tag
+        role_selectors = {r: (content_selectors.get(r, []), compiled_selectors.get(r)) for r in set(role_map.values())}
         for tag in soup.find_all(tags):
             role_key = role_map.get(tag.name)
             if not role_key: continue
-            content_html = extract_content_by_selectors(tag, content_selectors.get(role_key, []), fallback_html=True)
-            if content_html.strip(): turns.append({"role": role_key, "html": content_html})
+            selectors, joined_sel = role_selectors[role_key]
+            add_turn(role_key, extract_content_by_selectors(tag, selectors, fallback_html=True, joined_selector=joined_sel))
     elif method == "container_list":
         container_sel = profile.get("container_selector")
         content_selectors = profile.get("content_selectors", {})
+        compiled_selectors = profile.get("_compiled_selectors", {})
+        roles = set(profile.get("role_map", {}).values()) | set(content_selectors)
+        role_selectors = {r: (content_selectors.get(r, []), compiled_selectors.get(r)) for r in roles}
         if container_sel:
             elements = soup.select(container_sel)
             tag_set = set(id(e) for e in elements)
@@ -552,8 +798,8 @@ def extract_turns_from_soup(soup: BeautifulSoup, profile: dict) -> list[dict[str
                     continue
                 role_key = detect_role(tag, profile)
                 if not role_key or role_key == "unknown": continue
-                content_html = extract_content_by_selectors(tag, content_selectors.get(role_key, []), fallback_html=True)
-                if content_html.strip(): turns.append({"role": role_key, "html": content_html})
+                selectors, joined_sel = role_selectors.get(role_key, ([], None))
+                add_turn(role_key, extract_content_by_selectors(tag, selectors, fallback_html=True, joined_selector=joined_sel))
     elif method == "turn_list":
         turn_sel = profile.get("turn_selector")
         content_selectors = profile.get("content_selectors", {})
@@ -567,9 +813,7 @@ def extract_turns_from_soup(soup: BeautifulSoup, profile: dict) -> list[dict[str
                     for sel in content_selectors.get(role, []):
                         found = False
                         for el in turn_container.select(sel):
-                            content_html = clean_fragment_html(el.decode_contents())
-                            if content_html.strip():
-                                turns.append({"role": role, "html": content_html})
+                            if add_turn(role, el.decode_contents()):
                                 found = True
                                 break
                         if found:
@@ -591,46 +835,27 @@ def extract_turns_from_soup(soup: BeautifulSoup, profile: dict) -> list[dict[str
         for user_el, ai_el in zip(user_els, ai_els):
             content_el = user_el.select_one(user_content_sel) if user_content_sel else user_el
             if content_el:
-                content_html = clean_fragment_html(content_el.decode_contents())
-                if content_html.strip():
-                    turns.append({"role": "user", "html": content_html})
-            content_html = clean_fragment_html(ai_el.decode_contents())
-            if content_html.strip():
-                turns.append({"role": "ai", "html": content_html})
+                add_turn("user", content_el.decode_contents())
+            add_turn("ai", ai_el.decode_contents())
 
     if not turns:
         log_debug("Starting fallback tag-based extraction.")
-        potential_turns = soup.find_all(["div", "p", "span", "section", "article"])
         current_role, current_html = None, []
         def flush_tag(role, html_list):
             if role and html_list:
-                cleaned = clean_fragment_html("".join(html_list))
-                if cleaned: turns.append({"role": role, "html": cleaned})
-        
-        # Extended patterns for HTML elements containing text headers
-        user_re = r"^(You|User) said$|^You$|^User$|^##\s*User$|^User:$"
-        ai_re = r"^(Gemini|ChatGPT|Claude|AI) said$|^(Gemini|ChatGPT|Claude|AI)$|^##\s*AI$|^(Gemini|ChatGPT|Claude|AI):$"
-        
-        # Performance optimization: pre-calculate which elements are in potential_turns for faster lookup
-        tag_set = set(id(t) for t in potential_turns)
+                add_turn(role, "".join(html_list))
+
 
-        for elem in potential_turns:
-            text = elem.get_text().strip()
-            if re.match(user_re, text, re.I):
+        for elem, is_nested in _iter_fallback_candidates(soup):
+            text = _short_text(elem)
+            if text is not None and _USER_HEADER_RE.match(text):
                 flush_tag(current_role, current_html)
                 current_role, current_html = "user", []
-            elif re.match(ai_re, text, re.I):
+            elif text is not None and _AI_HEADER_RE.match(text):
                 flush_tag(current_role, current_html)
                 current_role, current_html = "ai", []
-            elif current_role and elem.name in ["div", "p", "pre", "span"]:
-                # Faster check for nested elements
-                is_nested = False
-                for parent in elem.parents:
-                    if id(parent) in tag_set:
-                        is_nested = True
-                        break
-                if not is_nested:
-                    current_html.append(str(elem))
+            elif current_role and elem.name in ["div", "p", "pre", "span"] and not is_nested:
+                current_html.append(str(elem))
         flush_tag(current_role, current_html)
         log_debug(f"Fallback extraction completed. Found {len(turns)} turns.")
     return turns
@@ -643,124 +868,197 @@ def shift_headers(soup: BeautifulSoup):
             h.name = f"h{i+1}"
     # h6 remains h6 or becomes h6 (Markdown limit)
 
-def html_to_markdown(turn_html: str, noise_patterns: list[str] = None) -> str:
-    soup = BeautifulSoup(turn_html, "html.parser")
-
+def node_to_markdown(soup: BeautifulSoup, noise_patterns: tuple[str, ...] = ()) -> str:
+    """Convert an already-parsed tree to Markdown. Note: shifts its headers in place."""
     # 1. Shift headers
     shift_headers(soup)
-    log_debug(f"Headers shifted. HTML state:\n{soup.prettify()[:500]}...")
-
-    def convert_element(el):
-        if el.name is None: # NavigableString
-            text = str(el)
+    if debug_enabled():
+        log_debug(f"Headers shifted. HTML state:\n{soup.prettify()[:500]}...")
+
+    def strip_pieces(out, start) -> bool:
+        """Strip whitespace from the joined pieces out[start:] in place, without joining them.
+        Returns False (leaving nothing behind) if they are all whitespace."""
+        end = len(out)
+        i = start
+        while i < end and (not out[i] or out[i].isspace()): i += 1
+        if i == end:
+            del out[start:]
+            return False
+        j = end - 1
+        while not out[j] or out[j].isspace(): j -= 1
+        del out[j + 1:]
+        out[j] = out[j].rstrip()
+        out[i] = out[i].lstrip()
+        del out[start:i]
+        return True
+
+    def emit_table(rows, out):
+        if not rows: return
+        if len(rows) > 1: rows.insert(1, _table_sep(rows[0].count("|") - 1))
+        out.append("\n\n" + "\n".join(rows) + "\n\n")
+
+    ws_sub = _WS_RE.sub
+
+    def convert_element(el, out, in_pre=False):
+        """Append the Markdown for el to out."""
+        name = el.name
+        if name is None: # NavigableString
             # Normalize HTML whitespace like browsers do: collapse whitespace to a single
             # space, except inside <pre> where whitespace is significant.
-            if el.find_parent("pre") is None:
-                text = re.sub(r'\s+', ' ', text)
-            return text
+            out.append(str(el) if in_pre else ws_sub(' ', el))
+            return
 
         # Hidden/Omitted tags
-        if el.name in ("script", "style", "noscript"):
-            return ""
+        if name in ("script", "style", "noscript"):
+            return
 
         # Gemini custom code-block element: extract language and code directly
         # to avoid the language label appearing as plain text before the fence.
-        if el.name == "code-block":
+        if name == "code-block":
             lang = ""
             dec = el.select_one("div.code-block-decoration")
             if dec:
                 sp = next((s for s in dec.find_all("span") if s.get_text().strip()), None)
                 if sp:
-                    lang = re.sub(r'\s+', ' ', sp.get_text()).strip()
+                    lang = _WS_RE.sub(' ', sp.get_text()).strip()
             code_el = el.find(attrs={"data-test-id": "code-content"}) or el.find("code")
             if code_el:
-                return f"\n\n```{lang}\n{code_el.get_text().rstrip()}\n```\n\n"
+                out.append(f"\n\n```{lang}\n{code_el.get_text().rstrip()}\n```\n\n")
+                return
             # Fall through to default processing if structure not recognized
 
-        # Recursive content
-        content = "".join(convert_element(child) for child in el.children).strip()
-        if not content and el.name not in ("br", "hr"):
-            return ""
-
-        if el.name in ("b", "strong"):
-            return f"**{content}**"
-        if el.name in ("i", "em"):
-            return f"*{content}*"
-        if el.name == "code":
-            if el.parent and el.parent.name == "pre": return content
-            return f"`{content}`"
-        if el.name == "br":
-            return "\n"
-        if el.name == "p":
-            return f"\n\n{content}\n\n"
-        if re.match(r"^h[1-6]$", el.name):
-            level = int(el.name[1])
-            return f"\n\n{'#' * level} {content}\n\n"
-        if el.name == "blockquote":
-            lines = content.split("\n")
-            return "\n" + "\n".join(f"> {l}" for l in lines) + "\n"
-        if el.name in ("ul", "ol"):
-            items = []
-            for idx, li in enumerate(el.find_all("li", recursive=False), 1):
-                li_content = "".join(convert_element(c) for c in li.children).strip()
-                prefix = f"{idx}." if el.name == "ol" else "-"
-                items.append(f"{prefix} {li_content}")
-            return "\n" + "\n".join(items) + "\n"
-        if el.name == "pre":
+        # Lists: convert each item once. The item contents double as the emptiness check,
+        # instead of converting the whole list generically first and then again per item.
+        if name in ("ul", "ol"):
+            items = []; has_content = False
+            for child in el.children:
+                child_out = []
+                if child.name == "li":
+                    for c in child.children:
+                        convert_element(c, child_out, in_pre)
+                    li_content = "".join(child_out).strip()
+                    prefix = f"{len(items) + 1}." if name == "ol" else "-"
+                    items.append(f"{prefix} {li_content}")
+                    has_content = has_content or bool(li_content)
+                elif not has_content:
+                    convert_element(child, child_out, in_pre)
+                    has_content = bool("".join(child_out).strip())
+            if has_content:
+                out.append("\n" + "\n".join(items) + "\n")
+            return
+
+        # Tables: convert the cells first; if any has text the table is non-empty and
+        # the generic conversion of its whole subtree can be skipped.
+        table_rows = None
+        if name == "table":
+            table_rows = []; has_cell_text = False
+            for tr in el.find_all("tr"):
+                cols = []
+                for td in tr.find_all(["td", "th"]):
+                    td_out = []
+                    for c in td.children:
+                        convert_element(c, td_out, in_pre)
+                    cell = "".join(td_out).strip()
+                    has_cell_text = has_cell_text or bool(cell)
+                    cols.append(cell.translate(_PIPE_ESCAPE))
+                if cols: table_rows.append("| " + " | ".join(cols) + " |")
+            if has_cell_text:
+                emit_table(table_rows, out)
+                return
+
+        # Recursive content goes after a placeholder slot reserved for the opening markup
+        in_pre = in_pre or name == "pre"
+        start = len(out)
+        out.append("")
+        for child in el.children:
+            convert_element(child, out, in_pre)
+        if not strip_pieces(out, start + 1) and name not in ("br", "hr"):
+            del out[start:]
+            return
+
+        if name in ("b", "strong"):
+            out[start] = "**"; out.append("**")
+            return
+        if name in ("i", "em"):
+            out[start] = "*"; out.append("*")
+            return
+        if name == "code":
+            if el.parent and el.parent.name == "pre": return
+            out[start] = "`"; out.append("`")
+            return
+        if name == "br":
+            del out[start:]
+            out.append("\n")
+            return
+        if name == "p":
+            out[start] = "\n\n"; out.append("\n\n")
+            return
+        if _HEADING_TAG_RE.match(name):
+            level = int(name[1])
+            out[start] = f"\n\n{'#' * level} "; out.append("\n\n")
+            return
+        if name == "blockquote":
+            lines = "".join(out[start:]).split("\n")
+            del out[start:]
+            out.append("\n" + "\n".join(f"> {l}" for l in lines) + "\n")
+            return
+        if name == "pre":
             code_tag = el.find("code")
             lang = ""
             if code_tag and code_tag.get("class"):
                 for cls in code_tag.get("class"):
                     if cls.startswith("language-"): lang = cls.replace("language-", "")
-            return f"\n\n``` {lang}\n{content}\n```\n\n"
-        if el.name == "table":
-            rows = []
-            for tr in el.find_all("tr"):
-                cols = []
-                for td in tr.find_all(["td", "th"]):
-                    cols.append("".join(convert_element(c) for c in td.children).strip().replace("|", "\\|"))
-                if cols: rows.append("| " + " | ".join(cols) + " |")
-            if rows:
-                first_row_cols = len(rows[0].split("|")) - 2
-                sep = "| " + " | ".join(["---"] * first_row_cols) + " |"
-                if len(rows) > 1: rows.insert(1, sep)
-                return "\n\n" + "\n".join(rows) + "\n\n"
+            out[start] = f"\n\n``` {lang}\n"; out.append("\n```\n\n")
+            return
+        if name == "table" and table_rows:
+            del out[start:]
+            emit_table(table_rows, out)
+            return
         
         # Treat Gemini/Angular wrapper elements as block-level so that code blocks
         # inside them retain their surrounding blank lines after stripping.
-        if el.name == "response-element":
-            return f"\n\n{content}\n\n" if content else ""
+        if name == "response-element":
+            out[start] = "\n\n"; out.append("\n\n")
+            return
 
         # ARIA role=heading support (e.g., Google AI Mode uses div[role=heading])
         if el.get("role") == "heading":
             level = int(el.get("aria-level", 3))
             level = max(1, min(6, level))
-            return f"\n\n{'#' * level} {content}\n\n"
+            out[start] = f"\n\n{'#' * level} "; out.append("\n\n")
+            return
 
-        # Default fallback for divs, spans, etc.
-        return content
+        # Default fallback for divs, spans, etc.: the content as-is
 
-    text = convert_element(soup).strip()
+    out: list[str] = []
+    convert_element(soup, out)
+    text = "".join(out).strip()
+    if not text: return ""
     
-    # 5. Clean up noise and whitespace
+    # 5. Clean up noise and whitespace (patterns are pre-filtered to non-empty strings by the caller)
     if noise_patterns:
         for p in noise_patterns:
-            if not p: continue
-            text = re.sub(rf"^\s*{re.escape(p)}\s*$", "", text, flags=re.M | re.I)
+            text = _noise_re(p).sub("", text)
             text = text.replace(p, "")
+            if not text: return ""
     
-    text = re.sub(r"^\s*.+ said\s*$", "", text, flags=re.M | re.I)
-    # Remove lines that contain only spaces/tabs (HTML formatting artefacts from
-    # whitespace-normalization of text nodes between block elements).
-    text = re.sub(r'^[ \t]+$', '', text, flags=re.M)
-    text = re.sub(r'\n{3,}', '\n\n', text)
+    # Remove "... said" label lines and lines that contain only spaces/tabs (HTML formatting
+    # artefacts from whitespace-normalization of text nodes between block elements) in one pass.
+    text = _LINE_NOISE_RE.sub("", text)
+    text = _BLANK_LINES_RE.sub('\n\n', text)
     return text.strip()
 
+# Drop control characters and backticks; replace characters invalid in Windows filenames
+_FNAME_TABLE = str.maketrans({
+    **{c: None for c in (*range(0x00, 0x20), *range(0x7f, 0xa0))},
+    **{ch: "_" for ch in '<>:"/\\|?*#'},
+    "`": None,
+})
+
 def sanitize_filename(name: str) -> str:
-    name = re.sub(r'[\x00-\x1f\x7f-\x9f]', "", name)
-    name = re.sub(r'[<>:"/\\|?*#]', "_", name)
-    name = name.replace("`", "").replace("*", "").replace("#", "").strip()
-    return name[:80]
+    return name.translate(_FNAME_TABLE).strip()[:80]
+
+_B64_CHARS = frozenset(string.ascii_letters + string.digits + "+/=" + string.whitespace)
 
 def main():
     global args
@@ -782,18 +1080,18 @@ def main():
 
     # Lock: prevent concurrent executions (skip in --test mode or if input file specified)
     use_lock = not args.test and not args.input_file
-    if use_lock:
-        if not acquire_lock():
-            status_cfg = config.get("clip", {}).get("notice", {}).get("status_toast", {})
+    with process_lock(use_lock) as acquired:
+        status_cfg = config.get("clip", {}).get("notice", {}).get("status_toast", {})
+        if not acquired:
             show_status_toast(config, "Chat Extractor", status_cfg.get("busy", "Already extracting, please wait."))
             print("Another instance is already running. Exiting.")
             return
-        show_status_toast(config, "Chat Extractor", config.get("clip", {}).get("notice", {}).get("status_toast", {}).get("processing", "Processing clipboard..."))
-
-    if use_lock:
-        import atexit
-        atexit.register(release_lock)
+        if use_lock:
+            show_status_toast(config, "Chat Extractor", status_cfg.get("processing", "Processing clipboard..."))
+        run_extraction(config)
 
+def run_extraction(config: dict):
+    """Read the input, extract the turns and write/copy the Markdown result."""
     content = ""
 
     if args.test:
@@ -805,7 +1103,7 @@ def main():
         # Try to decode as Base64 first
         try:
             # Check if it looks like base64 (alphanumeric, +, /, =)
-            if re.match(r'^[A-Za-z0-9+/=\s]+$', raw_text) and len(raw_text) % 4 == 0:
+            if len(raw_text) % 4 == 0 and _B64_CHARS.issuperset(raw_text):
                 raw_bytes = base64.b64decode(raw_text)
                 try: content = raw_bytes.decode('utf-8')
                 except UnicodeDecodeError: content = raw_bytes.decode('cp932', errors='replace')
@@ -816,8 +1114,8 @@ def main():
         
         content = try_repair_mojibake(content)
         if "StartFragment:" in content:
-            match = re.search(r'<!--StartFragment-->(.*)<!--EndFragment-->', content, re.DOTALL)
-            if match: content = match.group(1)
+            fragment = slice_fragment(content)
+            if fragment is not None: content = fragment
     if args.input_file:
         in_path = Path(args.input_file)
         if not in_path.exists():
@@ -831,26 +1129,34 @@ def main():
             print(f"Error reading file: {e}"); return
     else:
         if args.save_raw:
-            raw_b64 = get_clipboard_raw_b64()
-            if raw_b64:
+            raw_bytes = get_clipboard_raw()
+            if raw_bytes:
+                import base64
                 save_path = Path(args.save_raw)
                 save_path.parent.mkdir(parents=True, exist_ok=True)
-                save_path.write_text(raw_b64, encoding="utf-8")
+                save_path.write_text(base64.b64encode(raw_bytes).decode("ascii"), encoding="utf-8")
                 print(f"Raw clipboard data saved to: {args.save_raw}")
         content = get_clipboard_html()
 
     if not content or not content.strip():
         print("Clipboard or test file is empty."); return
 
-    hex_debug = " ".join(f"{ord(c):04x}" for c in content[:100])
-    log_debug(f"Raw content hex (first 100 chars): {hex_debug}")
+    if debug_enabled():
+        hex_debug = content[:100].encode("utf-8", "replace").hex(" ")
+        log_debug(f"Raw content hex (first 100 chars, UTF-8): {hex_debug}")
 
     log_debug(f"Input content length: {len(content)} chars.")
-    soup = BeautifulSoup(content, "html.parser")
-    log_debug("BeautifulSoup parsing complete.")
+    if "<" in content:
+        soup = _parse_html(content)
+        # Drop script/style payloads up front so profile detection and extraction never walk them
+        for el in soup.find_all(_NON_RENDERED_TAGS): el.decompose()
+        log_debug("BeautifulSoup parsing complete.")
+    else:
+        soup = None  # No markup at all: skip the HTML parse
+        log_debug("No markup found. Skipping HTML parsing.")
     profiles = load_profiles()
     log_debug(f"Loaded {len(profiles)} profiles.")
-    model_key, profile = detect_profile(soup, profiles)
+    model_key, profile = detect_profile(soup, content, profiles)
     
     if profile:
         print(f"Detected profile: {model_key}")
@@ -859,52 +1165,59 @@ def main():
         log_debug("AI model format not detected. Falling back to generic text extraction.")
 
     log_debug("Starting turn extraction...")
-    turns = extract_turns_from_soup(soup, profile)
+    turns = extract_turns_from_soup(soup, profile) if soup is not None else _extract_plaintext_turns(content)
     log_debug(f"Extraction complete. Found {len(turns)} turns.")
     if not turns:
         log_debug("Processing as plain text.")
-        turns = [{"role": "user", "html": content}]
+        turns = [{"role": "user", "tag": _parse_html(content)}]
         if model_key == "unknown": model_key = "text"
 
-    md_output = []; title = ""
-    title_tag = soup.find("title")
+    now = dt.datetime.now()
+    title = ""
+    title_tag = soup.find("title") if soup is not None else None
     if title_tag: title = title_tag.get_text().strip()
     if not title:
         for turn in turns:
             if turn["role"] == "user":
-                t_soup = BeautifulSoup(turn["html"], "html.parser")
-                title = t_soup.get_text().strip()[:40].split("\n")[0].strip()
+                title = _leading_text(turn["tag"], 40).partition("\n")[0].strip()
                 break
-    if not title: title = f"Chat_{dt.datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    if not title: title = f"Chat_{now.strftime('%Y%m%d_%H%M%S')}"
 
     print(f"Extracting: {title}")
 
-    md_output.append(f"# {title}\n\nModel Profile: {model_key}\nExtracted Date: {dt.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n---\n")
+    md_buf = io.StringIO()
+    md_buf.write(f"# {title}\n\nModel Profile: {model_key}\nExtracted Date: {now.strftime('%Y-%m-%d %H:%M:%S')}\n---\n")
     
-    # Merge noise patterns: Profile + Global 'removes'
-    noise = profile.get("noise_patterns", []) + config.get("removes", [])
+    # Merge noise patterns: Profile + Global 'removes' (deduplicated, empty entries dropped)
+    noise = tuple(dict.fromkeys(p for p in profile.get("noise_patterns", []) + config.get("removes", []) if p))
     
+    to_markdown, write, debug = node_to_markdown, md_buf.write, debug_enabled()
     for idx, turn in enumerate(turns):
         turn_num = idx + 1
         header = f"## {turn_num}. User" if turn["role"] == "user" else f"## {turn_num}. AI"
-        log_debug(f"Processing turn {idx} ({turn['role']})...")
-        text = html_to_markdown(turn["html"], noise_patterns=noise)
-        if text.strip(): md_output.append(f"{header}\n\n{text}\n")
+        if debug: log_debug(f"Processing turn {idx} ({turn['role']})...")
+        text = to_markdown(turn["tag"], noise_patterns=noise)
+        if text.strip():
+            # Sections are separated by a blank line; write the pieces instead of building each section
+            write("\n"); write(header); write("\n\n"); write(text); write("\n")
     log_debug("Turn processing complete.")
 
-    final_md = "\n".join(md_output)
+    final_md = md_buf.getvalue()
 
     filepath = None
     if config["output"]["enabled"]:
-        now = dt.datetime.now()
-        y_str = now.strftime(config.get("year_format", "%Y"))
-        m_str = now.strftime(config.get("month_format", "%m"))
-        d_str = now.strftime(config.get("date_format", "%Y%m%d"))
-        time_str = now.strftime(config["time_format"])
+        tokens = {
+            "year": now.strftime(config.get("year_format", "%Y")),
+            "month": now.strftime(config.get("month_format", "%m")),
+            "date": now.strftime(config.get("date_format", "%Y%m%d")),
+            "time": now.strftime(config["time_format"]),
+            "model": model_key,
+            "ai model": model_key,
+            "title": sanitize_filename(title),
+        }
         
         # Resolve variables in directory path
-        out_dir_tmpl = config["output"]["dir"]
-        resolved_out_dir = out_dir_tmpl.replace("{year}", y_str).replace("{month}", m_str).replace("{date}", d_str)
+        resolved_out_dir = fill_tokens(config["output"]["dir"], tokens)
         
         # Clean up quotes if they were accidentally included in config
         resolved_out_dir = resolved_out_dir.strip().strip('"').strip("'")
@@ -919,13 +1232,14 @@ def main():
         out_dir.mkdir(parents=True, exist_ok=True)
         
         # Resolve variables in filename
-        filename = config["output"]["filename"].replace("{year}", y_str).replace("{month}", m_str).replace("{date}", d_str)
-        filename = filename.replace("{time}", time_str).replace("{model}", model_key).replace("{ai model}", model_key).replace("{title}", sanitize_filename(title))
+        filename = fill_tokens(config["output"]["filename"], tokens)
         filename = filename.strip().strip('"').strip("'")
         
         filepath = out_dir / filename
         try:
-            filepath.write_text(final_md, encoding="utf-8-sig")
+            # UTF-8 with BOM; keep the platform newlines that text-mode writing produced
+            out_md = final_md if os.linesep == "\n" else final_md.replace("\n", os.linesep)
+            filepath.write_bytes(b"\xef\xbb\xbf" + out_md.encode("utf-8"))
             print("-" * 40)
             print(f"Success! Extracted {len(turns)} turns.")
             print(f"Saved to: {filepath}")